@@ -0,0 +1,57 @@
+import functools
+import inspect
+import time
+from copy import deepcopy
+
+CACHE_TTL = 24 * 60 * 60
+
+
+def ttl_cache(ttl: float = CACHE_TTL, ignore: tuple = (), copy: bool = True):
+    """
+    Cache a function's results in memory for a limited time.
+
+    The cache key is built from the bound call arguments, except the ones named in `ignore`
+    (e.g. sessions or headers, which don't change the result). The decorated function accepts
+    an extra `force_refresh` keyword argument that skips the cached value and stores a new one.
+    Cached values are deep-copied on return, so callers can't change them by accident, unless
+    `copy` is False (for private caches whose callers never modify or expose the cached value).
+    The decorated function also gets a `cached_at(*args, **kwargs)` method, returning the
+    `time.monotonic()` instant the value for those arguments was stored, or None if it isn't cached.
+
+    Args:
+        ttl (float, optional): Time, in seconds, a cached value stays valid. Defaults to one day.
+        ignore (tuple, optional): Argument names left out of the cache key.
+        copy (bool, optional): Return deep copies of the cached values. Defaults to True.
+
+    Returns:
+        Callable: The decorator.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        cache = {}
+
+        def make_key(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return tuple((name, value) for name, value in bound.arguments.items()
+                         if name not in ignore)
+
+        @functools.wraps(func)
+        def wrapper(*args, force_refresh: bool = False, **kwargs):
+            key = make_key(args, kwargs)
+            now = time.monotonic()
+            if not force_refresh and key in cache and now - cache[key][0] < ttl:
+                result = cache[key][1]
+            else:
+                result = func(*args, **kwargs)
+                cache[key] = (now, result)
+            return deepcopy(result) if copy else result
+
+        def cached_at(*args, **kwargs):
+            entry = cache.get(make_key(args, kwargs))
+            return entry[0] if entry is not None else None
+
+        wrapper.cache_clear = cache.clear
+        wrapper.cached_at = cached_at
+        return wrapper
+    return decorator
@@ -1,13 +1,27 @@
 import requests
+from importlib.util import find_spec
+from io import BytesIO
 from typing import List, Dict
 import pandas as pd
-from requests.sessions import default_headers
+from tqdm import tqdm
+from .cache import ttl_cache
+from .session import create_session
 
 BASE_URL = "http://dados.prefeitura.sp.gov.br"
 
+# python-calamine e orjson são opcionais: quando instalados, aceleram a leitura de planilhas
+# e das respostas JSON da API, respectivamente
+_HAS_CALAMINE = find_spec('python_calamine') is not None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 DEFAULT_HEADERS = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-    'Accept-Encoding': 'gzip, deflate, br, zstd',
+    # Só codificações que o urllib3 decodifica sem brotli/zstandard instalados
+    'Accept-Encoding': 'gzip, deflate',
     'Accept-Language': 'pt-BR,pt;q=0.9',
     'Connection': 'keep-alive',
     'Sec-Fetch-Dest': 'document',
@@ -21,32 +35,55 @@ DEFAULT_HEADERS = {
     'sec-ch-ua-platform': '"Android"'
 }
 
+# Sessão compartilhada: reaproveita conexões keep-alive entre as chamadas à API
+_SESSION = create_session(DEFAULT_HEADERS, pool_connections=10, pool_maxsize=20)
+
+
+def _parse_json(response: requests.Response):
+    """
+    Parses a JSON API response, using orjson when it's installed
+
+    Args:
+        response (requests.Response): API response
+
+    Returns:
+        Dict: The decoded JSON document
+    """
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
 
 def get_package_list(filter: str = None,
                      base_url: str = BASE_URL,
-                     headers: dict = DEFAULT_HEADERS) -> List[str]:
+                     headers: dict = DEFAULT_HEADERS,
+                     session: requests.Session = None) -> List[str]:
     """
     Fetches package list from dados.prefeitura.sp.gov.br API and returns as list
 
     Args:
         filter (str, optional): String to filter package names
         url (str): API endpoint URL
+        session (requests.Session, optional): Session used for the request.
+            Defaults to the module's shared session.
 
     Returns:
         List[str]: List containing the filtered package names
     """
 
+    session = session or _SESSION
     url = f'{base_url}/api/3/action/package_list'
     try:
-        response = requests.get(url, headers=default_headers)
+        response = session.get(url, headers=headers)
         response.raise_for_status()
-        data = response.json()
+        data = _parse_json(response)
 
         if data['success']:
             results = data['result']
             if filter:
+                f = filter.casefold()
                 return [pkg
-                        for pkg in results if filter.lower() in pkg.lower()]
+                        for pkg in results if f in pkg.casefold()]
             return results
         else:
             raise ValueError("API request unsuccessful")
@@ -55,24 +92,33 @@ def get_package_list(filter: str = None,
         raise Exception(f"Error fetching data: {str(e)}")
 
 
-def package_show(package: str, base_url: str = BASE_URL, headers: dict = DEFAULT_HEADERS) -> Dict:
+@ttl_cache(ignore=('headers', 'session'))
+def package_show(package: str,
+                 base_url: str = BASE_URL,
+                 headers: dict = DEFAULT_HEADERS,
+                 session: requests.Session = None) -> Dict:
     """
     Fetches package details from dados.prefeitura.sp.gov.br API
+    Results are cached in memory for a day; pass force_refresh=True to query the API again.
 
     Args:
         package (str): Package ID to fetch
         base_url (str): Base API URL
+        session (requests.Session, optional): Session used for the request.
+            Defaults to the module's shared session.
+        force_refresh (bool, optional): Ignore the cached result.
 
     Returns:
         Dict: Package details from API result
     """
+    session = session or _SESSION
     url = f'{base_url}/api/3/action/package_show'
     params = {'id': package}
 
     try:
-        response = requests.get(url, params=params, headers=headers)
+        response = session.get(url, params=params, headers=headers)
         response.raise_for_status()
-        data = response.json()
+        data = _parse_json(response)
 
         if data['success']:
             return data['result']
@@ -86,7 +132,8 @@ def package_show(package: str, base_url: str = BASE_URL, headers: dict = DEFAULT
 def package_resources(package: str,
                       filter: str = None,
                       base_url: str = BASE_URL,
-                      headers: dict = DEFAULT_HEADERS) -> List[Dict]:
+                      headers: dict = DEFAULT_HEADERS,
+                      session: requests.Session = None) -> List[Dict]:
     """
     Fetches package resources from dados.prefeitura.sp.gov.br API
 
@@ -94,23 +141,26 @@ def package_resources(package: str,
         package (str): Package ID to fetch
         filter (str, optional): String to filter resource names
         base_url (str): Base API URL
+        session (requests.Session, optional): Session used for the request.
+            Defaults to the module's shared session.
 
     Returns:
         List[Dict]: List of filtered resources with name and url
     """
     try:
-        package_data = package_show(package, base_url, headers)
+        package_data = package_show(package, base_url, headers, session)
         resources = package_data['resources']
 
+        f = filter.casefold() if filter else None
         filtered_resources = []
         for resource in resources:
             name = resource.get('name', '')
             url = resource.get('url', '')
             filename = url.split('/')[-1] if url else ''
             
-            if filter is None or (
-                (name and filter.lower() in name.lower()) or 
-                (filename and filter.lower() in filename.lower())
+            if f is None or (
+                (name and f in name.casefold()) or 
+                (filename and f in filename.casefold())
             ):
                 filtered_resources.append({
                     'name': name,
@@ -123,18 +173,52 @@ def package_resources(package: str,
     except Exception as e:
         raise Exception(f"Error fetching resources: {str(e)}")
 
+def _download(url: str, session: requests.Session, headers: dict) -> BytesIO:
+    """
+    Downloads a file through the given session into an in-memory buffer
+
+    Args:
+        url (str): File URL
+        session (requests.Session): Session used for the request
+        headers (dict): Request headers
+
+    Returns:
+        BytesIO: Buffer with the file contents, positioned at the start
+    """
+    buffer = BytesIO()
+    with session.get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        # Com Content-Encoding, o Content-Length é o tamanho comprimido, não o do arquivo
+        size = None
+        if 'Content-Encoding' not in response.headers:
+            size = int(response.headers.get('Content-Length', 0)) or None
+        with tqdm(total=size, unit='B', unit_scale=True, desc="Downloading resource", leave=False) as progress:
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                buffer.write(chunk)
+                progress.update(len(chunk))
+    buffer.seek(0)
+    return buffer
+
 def load_resource(resource_id: str,
                   base_url: str = BASE_URL,
                   headers: dict = DEFAULT_HEADERS,
-                  pandas_kwargs:dict={}) -> pd.DataFrame:
+                  pandas_kwargs:dict={},
+                  session: requests.Session = None) -> pd.DataFrame:
     """
     Loads a resource from dados.prefeitura.sp.gov.br API as a pandas DataFrame.
     
+    Spreadsheets are read with the calamine engine when python-calamine is installed. CSV resources
+    use pandas' default parser; to parse them with pyarrow instead, pass
+    pandas_kwargs={'engine': 'pyarrow', 'thousands': None} (the pyarrow engine doesn't support
+    the default thousands separator, and may infer column types differently, e.g. dates).
+    
     Args:
         resource_id (str): Resource ID to fetch from the API
         base_url (str, optional): Base API URL. Defaults to BASE_URL.
         pandas_header (List[int], optional): List of row indices to use as column headers. 
             Defaults to [0].
+        session (requests.Session, optional): Session used for the request.
+            Defaults to the module's shared session.
     
     Returns:
         pd.DataFrame: Resource data loaded as a pandas DataFrame
@@ -147,13 +231,14 @@ def load_resource(resource_id: str,
         >>> df = load_resource("abc123")  # Single header row
         >>> df = load_resource("xyz789", pandas_header=[0,1])  # Multi-index headers
     """
+    session = session or _SESSION
     url = f'{base_url}/api/3/action/resource_show'
     params = {'id': resource_id}
     
     try:
-        response = requests.get(url, params=params, headers=headers)
+        response = session.get(url, params=params, headers=headers)
         response.raise_for_status()
-        data = response.json()
+        data = _parse_json(response)
         
         if data['success']:
             result = data['result']
@@ -173,12 +258,16 @@ def load_resource(resource_id: str,
                     'encoding': 'latin1'
                 }
                 csv_default_kwargs.update(pandas_kwargs)
-                return pd.read_csv(resource_url, **csv_default_kwargs)
+                buffer = _download(resource_url, session, headers)
+                return pd.read_csv(buffer, **csv_default_kwargs)
             elif any(t in ['xls', 'xlsx', 'excel', 'ods'] for t in [mimetype, format, url_ext]):
                 excel_default_kwargs = {
                 }
+                if _HAS_CALAMINE:
+                    excel_default_kwargs['engine'] = 'calamine'
                 excel_default_kwargs.update(pandas_kwargs)
-                return pd.read_excel(resource_url, **excel_default_kwargs)
+                buffer = _download(resource_url, session, headers)
+                return pd.read_excel(buffer, **excel_default_kwargs)
             else:
                 raise ValueError(f"Unsupported file format: {mimetype or format or url_ext}")
                 
@@ -1,69 +1,118 @@
-import requests
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
 import xml.etree.ElementTree as ET
 import geopandas as gpd
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from tqdm import tqdm
 import pandas as pd
+import requests
+from .cache import CACHE_TTL, ttl_cache
+from .session import create_session
 
 BASE_URL = 'https://wfs.geosampa.prefeitura.sp.gov.br/geoserver/geoportal/wfs'
 SERVICE = 'WFS'
 WFS_VERSION = '1.1.0'
+WFS_HITS_VERSION = '2.0.0'
 SERVER_MAXIMUM_FEATURES = 30000
+MAX_CONCURRENT_REQUESTS = 8
+CACHE_DIR = Path.home() / '.cache' / 'datasp' / 'geosampa'
+
+# Sessão compartilhada: as páginas baixadas em paralelo reaproveitam as mesmas conexões,
+# limitadas a MAX_CONCURRENT_REQUESTS (sem abrir conexões avulsas quando o pool está ocupado)
+_SESSION = create_session(pool_connections=1,
+                          pool_maxsize=MAX_CONCURRENT_REQUESTS,
+                          pool_block=True)
 
-def get_capabilities(filter: str = None):
+# Cache privado: get_capabilities copia só os itens que devolve
+@ttl_cache(copy=False)
+def _raw_capabilities():
     """
-    Retrieve WFS capabilities and extract feature types.
+    Retrieve WFS capabilities and extract every feature type, with casefolded copies of its
+    name, title and abstract for filtering.
+    Results are cached in memory for a day; pass force_refresh=True to query the server again.
     
     Args:
-        filter (str, optional): Filter text to match feature names, titles, or abstracts.
+        force_refresh (bool, optional): Ignore the cached result.
     
     Returns:
-        list[dict]: List of feature type dictionaries with keys 'name', 'title', and 'abstract'.
+        list[tuple]: List of (name, title, abstract, feature_type) tuples, where the first three are
+            casefolded and feature_type is a dictionary with keys 'name', 'title', and 'abstract'.
     """
     params = {
         'service': SERVICE,
         'version': WFS_VERSION, 
         'request': 'GetCapabilities'
     }
-    response = requests.get(BASE_URL, params=params)
-    response.raise_for_status()
-    
-    root = ET.fromstring(response.content)
     namespaces = {
         'wfs': 'http://www.opengis.net/wfs',
         'ows': 'http://www.opengis.net/ows'
     }
+    feature_type_tag = f"{{{namespaces['wfs']}}}FeatureType"
     
     feature_types = []
-    for ft in root.findall(".//wfs:FeatureType", namespaces):
-        name_elem = ft.find("wfs:Name", namespaces)
-        title_elem = ft.find("wfs:Title", namespaces)
-        abstract_elem = ft.find("wfs:Abstract", namespaces)
-        
-        if name_elem is not None:
-            name = name_elem.text if name_elem is not None else ''
-            title = title_elem.text if title_elem is not None else ''
-            abstract = abstract_elem.text if abstract_elem is not None else ''
-
-            name = name if name is not None else ''
-            title = title if title is not None else ''
-            abstract = abstract if abstract is not None else ''
+    with _SESSION.get(BASE_URL, params=params, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+
+        # Lê o documento em streaming, descartando cada FeatureType depois de processado
+        for _, ft in ET.iterparse(response.raw):
+            if ft.tag != feature_type_tag:
+                continue
+
+            name_elem = ft.find("wfs:Name", namespaces)
+            title_elem = ft.find("wfs:Title", namespaces)
+            abstract_elem = ft.find("wfs:Abstract", namespaces)
             
-            if filter is None or (
-                filter.lower() in name.lower() or
-                filter.lower() in title.lower() or 
-                filter.lower() in abstract.lower()
-            ):
-                feature_types.append({
-                    'name': name,
-                    'title': title,
-                    'abstract': abstract
-                })
+            if name_elem is not None:
+                name = name_elem.text if name_elem is not None else ''
+                title = title_elem.text if title_elem is not None else ''
+                abstract = abstract_elem.text if abstract_elem is not None else ''
+
+                name = name if name is not None else ''
+                title = title if title is not None else ''
+                abstract = abstract if abstract is not None else ''
+                
+                feature_types.append((
+                    name.casefold(),
+                    title.casefold(),
+                    abstract.casefold(),
+                    {
+                        'name': name,
+                        'title': title,
+                        'abstract': abstract
+                    }
+                ))
+            ft.clear()
     return feature_types
 
-def get_feature_count(feature_type: str, sortBy: str = None):
+def get_capabilities(filter: str = None, force_refresh: bool = False):
     """
-    Get the total feature count for the specified feature type with pagination.
+    Retrieve WFS capabilities and extract feature types.
+    The capabilities document is cached in memory for a day; pass force_refresh=True to query the
+    server again.
+    
+    Args:
+        filter (str, optional): Filter text to match feature names, titles, or abstracts.
+        force_refresh (bool, optional): Ignore the cached capabilities.
+    
+    Returns:
+        list[dict]: List of feature type dictionaries with keys 'name', 'title', and 'abstract'.
+    """
+    f = filter.casefold() if filter else None
+    return [
+        dict(feature_type)
+        for name, title, abstract, feature_type in _raw_capabilities(force_refresh=force_refresh)
+        if f is None or f in name or f in title or f in abstract
+    ]
+
+def _count_features_paginated(feature_type: str, sortBy: str = None):
+    """
+    Count features by paging through WFS 1.1.0 hits requests of SERVER_MAXIMUM_FEATURES each.
     
     Args:
         feature_type (str): The feature type name.
@@ -86,7 +135,7 @@ def get_feature_count(feature_type: str, sortBy: str = None):
         }
         if sortBy:
             params.update({'sortBy': sortBy})
-        response = requests.get(BASE_URL, params=params)
+        response = _SESSION.get(BASE_URL, params=params)
         response.raise_for_status()
         root = ET.fromstring(response.content)
         count = int(root.attrib.get('numberOfFeatures', 0))
@@ -96,12 +145,57 @@ def get_feature_count(feature_type: str, sortBy: str = None):
         offset += SERVER_MAXIMUM_FEATURES
     return total
 
+@ttl_cache()
+def get_feature_count(feature_type: str, sortBy: str = None):
+    """
+    Get the total feature count for the specified feature type.
+    
+    Asks for the total in a single WFS 2.0.0 hits request (numberMatched). If that request fails
+    or the server doesn't report the total, falls back to counting with paginated WFS 1.1.0 hits
+    requests.
+    Results are cached in memory for a day; pass force_refresh=True to query the server again.
+    
+    Args:
+        feature_type (str): The feature type name.
+        sortBy (str, optional): Column name to sort results.
+        force_refresh (bool, optional): Ignore the cached result.
+    
+    Returns:
+        int: Total number of features.
+    """
+    params = {
+        'service': SERVICE,
+        'version': WFS_HITS_VERSION,
+        'request': 'GetFeature',
+        'typeNames': feature_type,
+        'resultType': 'hits'
+    }
+    if sortBy:
+        params.update({'sortBy': sortBy})
+    try:
+        response = _SESSION.get(BASE_URL, params=params)
+    except requests.RequestException:
+        # Inclui o RetryError levantado depois de esgotadas as novas tentativas
+        response = None
+    if response is not None and response.ok:
+        try:
+            number_matched = ET.fromstring(response.content).attrib.get('numberMatched', '')
+        except ET.ParseError:
+            number_matched = ''
+        # numberMatched pode vir como 'unknown'
+        if number_matched.isdigit():
+            return int(number_matched)
+    return _count_features_paginated(feature_type, sortBy)
+
+@ttl_cache()
 def get_feature_columns(feature_type: str):
     """
     Retrieve the list of column names for a given feature type using DescribeFeatureType.
+    Results are cached in memory for a day; pass force_refresh=True to query the server again.
     
     Args:
         feature_type (str): The feature type name.
+        force_refresh (bool, optional): Ignore the cached result.
     
     Returns:
         list[str]: List of column names.
@@ -112,7 +206,7 @@ def get_feature_columns(feature_type: str):
         'request': 'DescribeFeatureType',
         'typeName': feature_type
     }
-    response = requests.get(BASE_URL, params=params)
+    response = _SESSION.get(BASE_URL, params=params)
     response.raise_for_status()
     tree = ET.fromstring(response.content)
     ns = { "xsd": "http://www.w3.org/2001/XMLSchema" }
@@ -123,7 +217,7 @@ def get_feature_columns(feature_type: str):
             columns.append(name)
     return columns
 
-def determine_sort_column(feature_type: str):
+def determine_sort_column(feature_type: str, force_refresh: bool = False):
     """
     Determine the sorting column from the feature's schema.
     
@@ -131,12 +225,13 @@ def determine_sort_column(feature_type: str):
     
     Args:
         feature_type (str): The feature type name.
+        force_refresh (bool, optional): Ignore the cached schema and query the server again.
     
     Returns:
         str or None: The column name to sort by, or None if no relevant column is found.
     """
     # Obtém a estrutura da feature diretamente do servidor
-    columns = get_feature_columns(feature_type)
+    columns = get_feature_columns(feature_type, force_refresh=force_refresh)
     feature_name = feature_type.split(":")[-1]
     best_candidate = f"cd_identificador_{feature_name}"
     if best_candidate in columns:
@@ -146,16 +241,140 @@ def determine_sort_column(feature_type: str):
             return col
     return None
 
+def _open_snapshot(feature_type: str, base_params: dict, page_size: int, total: int,
+                   total_is_fresh: bool, force_refresh: bool = False):
+    """
+    Open the disk cache snapshot of a layer, starting a new one if needed.
+    
+    All pages of a (typeName, sortBy, page size) pagination live in one directory, together with a
+    manifest holding the snapshot's creation time and feature count. The pages are only valid as a
+    whole: when the snapshot expires (CACHE_TTL) or the layer's count changes, every page is
+    discarded, so one result never mixes pages taken from different versions of the layer.
+    
+    Args:
+        feature_type (str): The feature type name.
+        base_params (dict): WFS GetFeature request parameters shared by all pages.
+        page_size (int): Maximum features per page.
+        total (int): Current feature count of the layer.
+        total_is_fresh (bool): Whether `total` was just fetched from the server (rather than from
+            the in-memory cache). If not, the layer is counted again when a new snapshot starts.
+        force_refresh (bool, optional): Start a new snapshot even if the cached one is still valid.
+    
+    Returns:
+        tuple[Path, int]: The snapshot directory and the feature count the snapshot was taken with.
+    """
+    key = hashlib.blake2b(repr((sorted(base_params.items()), page_size)).encode(),
+                          digest_size=16).hexdigest()
+    directory = CACHE_DIR / key
+    manifest_path = directory / 'manifest.json'
+
+    try:
+        manifest = json.loads(manifest_path.read_text())
+    except (OSError, ValueError):
+        manifest = None
+
+    if (not force_refresh and manifest is not None
+            and time.time() - manifest['created'] < CACHE_TTL
+            and manifest['total'] == total):
+        return directory, total
+
+    # A contagem veio do cache em memória: conta de novo, junto com o novo snapshot
+    if not total_is_fresh:
+        total = get_feature_count(feature_type, force_refresh=True)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_path = directory / 'manifest.json.tmp'
+    tmp_path.write_text(json.dumps({'created': time.time(), 'total': total}))
+    os.replace(tmp_path, manifest_path)
+    return directory, total
+
+def _check_feature_response(response):
+    """
+    Make sure a GetFeature response carries features.
+    GeoServer reports WFS errors as an XML ServiceExceptionReport with HTTP status 200.
+    
+    Args:
+        response (requests.Response): Response to a JSON GetFeature request.
+    
+    Raises:
+        requests.HTTPError: If the request failed.
+        ValueError: If the server answered with something other than JSON.
+    """
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '')
+    if 'json' not in content_type:
+        raise ValueError(f"Unexpected GeoSampa response ({content_type or 'no Content-Type'}): "
+                         f"{response.text[:500]}")
+
+def _download_page(params: dict, path: Path):
+    """
+    Stream a GetFeature page to disk, replacing the file only once the download is complete and
+    the server answered with features (not an error report).
+    
+    Args:
+        params (dict): WFS GetFeature request parameters.
+        path (Path): Destination file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as tmp:
+        try:
+            with _SESSION.get(BASE_URL, params=params, stream=True) as response:
+                _check_feature_response(response)
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, tmp)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    os.replace(tmp.name, path)
+
+def _fetch_page(params: dict, path: Path = None):
+    """
+    Download a single GetFeature page and parse it as a GeoDataFrame.
+    
+    Args:
+        params (dict): WFS GetFeature request parameters.
+        path (Path, optional): Cache file of the page inside its snapshot. The page is only
+            downloaded if the file doesn't exist yet. If not provided, the page isn't cached.
+    
+    Returns:
+        GeoDataFrame: The features contained in the page.
+    """
+    if path is None:
+        # Lê o corpo direto do socket, sem materializar response.content/.text
+        with _SESSION.get(BASE_URL, params=params, stream=True) as response:
+            _check_feature_response(response)
+            response.raw.decode_content = True
+            return gpd.read_file(response.raw)
+
+    if not path.exists():
+        _download_page(params, path)
+    try:
+        return gpd.read_file(path)
+    except Exception:
+        # Não mantém no cache uma página que não pode ser lida
+        path.unlink(missing_ok=True)
+        raise
+
 def get_features(feature_type: str,
                  output_format: str = 'application/json',
-                 wfs_max_features: int = 10000):
+                 wfs_max_features: int = 10000,
+                 cache: bool = True,
+                 force_refresh: bool = False):
     """
     Retrieve features for the given feature type, either in a single request or in multiple paginated requests.
+    Pages are downloaded concurrently (up to MAX_CONCURRENT_REQUESTS at a time) and kept in a disk
+    cache (CACHE_DIR), so later calls only download the pages that are missing. The cached pages of a
+    layer form a single snapshot, discarded as a whole after CACHE_TTL seconds or when the layer's
+    feature count changes.
     
     Args:
         feature_type (str): The feature type name.
         output_format (str, optional): Desired output format, defaults to 'application/json'.
         wfs_max_features (int, optional): Maximum features per request when paginating.
+        cache (bool, optional): Use the disk cache for the downloaded pages. Defaults to True.
+        force_refresh (bool, optional): Ignore cached metadata and pages and download everything again.
     
     Returns:
         GeoDataFrame: A GeoPandas GeoDataFrame with the requested features.
@@ -163,8 +382,18 @@ def get_features(feature_type: str,
     Raises:
         ValueError: If the output_format is unsupported.
     """
-    sort_col = determine_sort_column(feature_type)
-    total = get_feature_count(feature_type, sort_col)
+    if output_format != "application/json":
+        raise ValueError(f"Unsupported output_format: {output_format}")
+
+    started = time.monotonic()
+    # O esquema e a contagem não dependem um do outro: consulta os dois em paralelo
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sort_col_future = executor.submit(determine_sort_column, feature_type,
+                                          force_refresh=force_refresh)
+        total_future = executor.submit(get_feature_count, feature_type,
+                                       force_refresh=force_refresh)
+        sort_col = sort_col_future.result()
+        total = total_future.result()
     base_params = {
         'service': SERVICE,
         'version': WFS_VERSION,
@@ -175,31 +404,26 @@ def get_features(feature_type: str,
     if sort_col:
         base_params.update({'sortBy': sort_col})
 
+    if cache:
+        counted_at = get_feature_count.cached_at(feature_type)
+        total_is_fresh = counted_at is not None and counted_at >= started
+        snapshot, total = _open_snapshot(feature_type, base_params, wfs_max_features, total,
+                                         total_is_fresh, force_refresh=force_refresh)
+
     if total <= wfs_max_features:
-        params = base_params.copy()
-        response = requests.get(BASE_URL, params=params)
-        response.raise_for_status()
-        
-        if output_format == "application/json":
-            return gpd.read_file(StringIO(response.text))
-        else:
-            raise ValueError(f"Unsupported output_format: {output_format}")
-    else:
-        gdf_list = []
-        for start in tqdm(range(0, total, wfs_max_features), desc="Downloading features"):
-            params = base_params.copy()
-            params.update({
-                'startIndex': start,
-                'maxFeatures': wfs_max_features
-            })
-            response = requests.get(BASE_URL, params=params)
-            response.raise_for_status()
-            
-            if output_format == "application/json":
-                gdf_list.append(gpd.read_file(StringIO(response.text)))
-            else:
-                raise ValueError(f"Unsupported output_format: {output_format}")
-        final_gdf = gpd.GeoDataFrame(pd.concat(gdf_list, ignore_index=True))
-        final_gdf = final_gdf.set_geometry(gdf_list[0].geometry.name)
-        final_gdf = final_gdf.set_crs(gdf_list[0].crs)
-        return final_gdf
+        return _fetch_page(base_params, snapshot / 'page.json' if cache else None)
+
+    params_list = [
+        {**base_params, 'startIndex': start, 'maxFeatures': wfs_max_features}
+        for start in range(0, total, wfs_max_features)
+    ]
+    paths = [snapshot / f"page_{params['startIndex']}.json" if cache else None
+             for params in params_list]
+    # As páginas são independentes: baixa em paralelo, mantendo a ordem original
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        gdf_list = list(tqdm(executor.map(_fetch_page, params_list, paths),
+                             total=len(params_list),
+                             desc="Downloading features"))
+    # Todas as páginas compartilham esquema e CRS: o concat já devolve um GeoDataFrame
+    # com a geometria e o CRS preservados, sem precisar reconstruí-lo
+    return pd.concat(gdf_list, ignore_index=True)
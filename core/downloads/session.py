@@ -0,0 +1,46 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def create_session(headers: dict = None,
+                   pool_connections: int = 10,
+                   pool_maxsize: int = 10,
+                   pool_block: bool = False) -> requests.Session:
+    """
+    Create a requests Session with connection pooling and automatic retries.
+
+    GET requests answered with 429 or a transient 5xx status are retried up to 5 times,
+    with exponential backoff plus jitter, honoring the server's Retry-After header.
+
+    Args:
+        headers (dict, optional): Headers sent with every request made by the session.
+        pool_connections (int, optional): Number of host pools to keep.
+        pool_maxsize (int, optional): Maximum number of connections kept per host.
+        pool_block (bool, optional): Wait for a free pooled connection instead of opening
+            extra, non-reusable ones when all `pool_maxsize` connections are busy.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    retry = Retry(
+        total=5,
+        backoff_factor=1.0,
+        backoff_jitter=0.5,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=frozenset(['GET']),
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(max_retries=retry,
+                          pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          pool_block=pool_block)
+
+    session = requests.Session()
+    if headers:
+        session.headers.update(headers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
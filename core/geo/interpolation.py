@@ -1,12 +1,22 @@
+import numpy as np
+import pandas as pd
+import shapely
 from geopandas import GeoDataFrame
 
+from .parallel import map_chunks
+
+
+def _intersection_areas(left_geoms, right_geoms):
+    return shapely.area(shapely.intersection(left_geoms, right_geoms))
+
 
 def areal_weighted_interpolation(
         left: GeoDataFrame,
         right: GeoDataFrame,
         right_id_col: str,
         original_var_name: str,
-        final_var_name: str = None):
+        final_var_name: str = None,
+        n_jobs: int = None):
     """
     Perform areal weighted interpolation between two GeoDataFrames.
     This function calculates the weighted interpolation of a variable from one GeoDataFrame (`left`) 
@@ -25,6 +35,9 @@ def areal_weighted_interpolation(
     final_var_name : str, optional
     The column name for the interpolated variable in the resulting GeoDataFrame. 
     If not provided, the `original_var_name` will be used.
+    n_jobs : int, optional
+    Maximum number of threads used to compute the intersection areas.
+    If not provided, `os.cpu_count()` will be used.
     Returns:
     --------
     final_gdf : gpd.GeoDataFrame
@@ -32,7 +45,11 @@ def areal_weighted_interpolation(
     Notes:
     ------
     - The function assumes that both GeoDataFrames use the same coordinate reference system (CRS).
-    - The intersection areas are calculated using the `gpd.overlay` method with `how='intersection'`.
+    - The intersecting pairs are found with a `shapely.STRtree` query and their intersection areas are
+        calculated at once with the vectorized `shapely.intersection`. Pairs that only touch (zero
+        intersection area) are ignored, as in `gpd.overlay` with `keep_geom_type=True`.
+    - Shapely releases the GIL while computing intersections, so large sets of pairs are split in
+        chunks and processed by a thread pool.
     - The interpolated variable is calculated as the product of the original variable and the 
         proportion of intersection area relative to the total area of the `left` GeoDataFrame.
     Example:
@@ -46,36 +63,39 @@ def areal_weighted_interpolation(
     >>> interpolated_gdf.head()
     """
 
-    left = left.copy()
-    right = right.copy()
+    if not final_var_name:
+        final_var_name = original_var_name
 
-    left['total_area'] = left.area
+    left_geoms = left.geometry.to_numpy()
+    right_geoms = right.geometry.to_numpy()
 
-    inter = left.overlay(
-        right,
-        how='intersection',
-        keep_geom_type=True)
+    tree = shapely.STRtree(right_geoms)
+    left_idx, right_idx = tree.query(left_geoms, predicate='intersects')
 
-    inter['intersection_area'] = inter.area
+    inter_areas = map_chunks(_intersection_areas,
+                             [left_geoms[left_idx], right_geoms[right_idx]],
+                             n_jobs)
+    total_areas = shapely.area(left_geoms)
 
-    inter['inter_prop'] = inter['intersection_area']/inter['total_area']
+    right_codes, right_ids = pd.factorize(right[right_id_col])
+    pair_codes = right_codes[right_idx]
 
-    if not final_var_name:
-        final_var_name = original_var_name
+    keep = (inter_areas > 0) & (pair_codes >= 0)
+    left_idx, pair_codes, inter_areas = left_idx[keep], pair_codes[keep], inter_areas[keep]
 
-    inter[final_var_name] = inter[original_var_name]*inter['inter_prop']
+    values = np.nan_to_num(left[original_var_name].to_numpy(dtype=float))
+    contrib = values[left_idx] * inter_areas / total_areas[left_idx]
 
-    right_interpolated = (
-        inter
-        .loc[:, [right_id_col, final_var_name]]
-        .groupby(right_id_col)
-        .sum()
-        .round(0)
-        .reset_index()
-    )
+    # Soma as contribuições de cada par na unidade de destino correspondente
+    sums = np.zeros(len(right_ids))
+    np.add.at(sums, pair_codes, contrib)
+    matched = np.zeros(len(right_ids), dtype=bool)
+    matched[pair_codes] = True
 
-    right_interpolated[final_var_name] = right_interpolated[final_var_name].astype(int)
-    right_interpolated
+    right_interpolated = pd.DataFrame({
+        right_id_col: right_ids[matched],
+        final_var_name: sums[matched].round(0).astype(int)
+    })
 
     final_gdf = right.merge(
         right_interpolated,
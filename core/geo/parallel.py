@@ -0,0 +1,38 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Abaixo disso, o custo de criar as threads supera o ganho
+MIN_PAIRS_PER_THREAD = 1000
+
+
+def map_chunks(func, arrays: list, n_jobs: int = None) -> np.ndarray:
+    """
+    Apply a vectorized shapely function to aligned arrays, split in chunks processed by a thread pool.
+    Parameters:
+    -----------
+    func : Callable
+    Vectorized function taking one array per element of `arrays` and returning an array.
+    arrays : list of np.ndarray
+    Aligned arrays passed to `func`.
+    n_jobs : int, optional
+    Maximum number of threads. If not provided, `os.cpu_count()` will be used.
+    Returns:
+    --------
+    result : np.ndarray
+    The concatenated results of `func`.
+    Notes:
+    ------
+    - Shapely releases the GIL while running GEOS operations, so the chunks run in parallel.
+    - Inputs with fewer than `MIN_PAIRS_PER_THREAD` elements per thread use fewer threads; when a
+        single chunk is left, `func` is called directly, without starting a thread pool.
+    """
+    n_chunks = max(1, min(n_jobs or os.cpu_count() or 1,
+                          len(arrays[0]) // MIN_PAIRS_PER_THREAD))
+    if n_chunks == 1:
+        return func(*arrays)
+
+    with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+        return np.concatenate(list(executor.map(
+            func, *(np.array_split(array, n_chunks) for array in arrays))))
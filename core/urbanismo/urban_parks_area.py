@@ -1,10 +1,174 @@
-from geopandas import GeoDataFrame
+import re
+
+import numpy as np
+import pandas as pd
+import shapely
+from geopandas import GeoDataFrame, GeoSeries
+
+from core.geo.parallel import map_chunks
+
+POLYGON_TYPE_IDS = (3, 6)
+GEOMETRYCOLLECTION_TYPE_ID = 7
+
+
+def _sanitize(gdf:GeoDataFrame) -> GeoDataFrame:
+    """
+    Repair invalid geometries with `shapely.make_valid` and drop rows with empty geometries, so that
+    GEOS doesn't fall into its slow (or failing) paths for invalid input during the overlays.
+    Parameters:
+        gdf (GeoDataFrame): GeoDataFrame to be sanitized.
+    Returns:
+        GeoDataFrame: `gdf` itself when all geometries are already valid and non-empty; otherwise a
+            new GeoDataFrame with the repaired geometries and without the empty ones.
+    """
+    geoms = gdf.geometry.to_numpy()
+    invalid = ~shapely.is_valid(geoms)
+    empty = shapely.is_empty(geoms)
+    if not invalid.any() and not empty.any():
+        return gdf
+
+    geoms = geoms.copy()
+    geoms[invalid] = shapely.make_valid(geoms[invalid])
+    keep = np.flatnonzero(~shapely.is_empty(geoms))
+    result = gdf.iloc[keep].copy()
+    result[gdf.geometry.name] = GeoSeries(geoms[keep], index=result.index, crs=gdf.crs)
+    return result
+
+
+def _difference(gdf:GeoDataFrame, other:GeoDataFrame, n_jobs:int = None) -> GeoDataFrame:
+    """
+    Subtract the geometries of `other` from each geometry of `gdf`.
+    Equivalent to `gdf.overlay(other, how='difference')`, but vectorized: the candidates of each
+    geometry are found with an STRtree, merged with a single union per geometry and subtracted
+    with one call to `shapely.difference`.
+    Parameters:
+        gdf (GeoDataFrame): GeoDataFrame whose geometries are clipped.
+        other (GeoDataFrame): GeoDataFrame with the geometries to be subtracted.
+        n_jobs (int, optional): Maximum number of threads used to compute the differences.
+    Returns:
+        GeoDataFrame: The rows of `gdf` with their remaining geometries. Rows left with an empty
+            geometry are dropped and the index is reset, as in `overlay`.
+    """
+    geoms = gdf.geometry.to_numpy()
+    other_geoms = other.geometry.to_numpy()
+
+    tree = shapely.STRtree(other_geoms)
+    src, tgt = tree.query(geoms, predicate='intersects')
+    order = np.argsort(src, kind='stable')
+    src, tgt = src[order], tgt[order]
+
+    # Une, para cada geometria, todos os candidatos que a intersectam
+    hits, starts = np.unique(src, return_index=True)
+    groups = np.split(tgt, starts[1:]) if len(hits) else []
+    unions = np.array([shapely.union_all(other_geoms[group]) for group in groups], dtype=object)
+
+    new_geoms = geoms.copy()
+    new_geoms[hits] = map_chunks(shapely.difference, [geoms[hits], unions], n_jobs)
+
+    keep = np.flatnonzero(~shapely.is_empty(new_geoms))
+    result = gdf.iloc[keep].copy()
+    result[gdf.geometry.name] = GeoSeries(new_geoms[keep], index=result.index, crs=gdf.crs)
+    return result.reset_index(drop=True)
+
+
+def _keep_polygons(geoms:np.ndarray) -> np.ndarray:
+    """
+    Reduce geometries to their polygonal parts, as `overlay(..., keep_geom_type=True)` does for
+    polygon inputs: polygonal parts of GeometryCollections are kept and any other geometry type
+    becomes empty.
+    Parameters:
+        geoms (np.ndarray): Array of shapely geometries.
+    Returns:
+        np.ndarray: Array of polygonal (or empty) geometries. When all geometries are already
+            polygonal, `geoms` itself is returned.
+    """
+    type_ids = shapely.get_type_id(geoms)
+    polygonal = np.isin(type_ids, POLYGON_TYPE_IDS)
+    if polygonal.all():
+        return geoms
+
+    geoms = geoms.copy()
+    # Coleções são raras: extrai os polígonos de cada uma individualmente
+    for i in np.flatnonzero(type_ids == GEOMETRYCOLLECTION_TYPE_ID):
+        parts = shapely.get_parts(geoms[i])
+        polygons = parts[np.isin(shapely.get_type_id(parts), POLYGON_TYPE_IDS)]
+        geoms[i] = shapely.union_all(polygons)
+
+    geoms[~polygonal & (type_ids != GEOMETRYCOLLECTION_TYPE_ID)] = shapely.Polygon()
+    return geoms
+
+
+def _intersection(gdf:GeoDataFrame, other:GeoDataFrame, n_jobs:int = None) -> GeoDataFrame:
+    """
+    Intersect the geometries of `gdf` with the geometries of `other`.
+    Equivalent to `gdf.overlay(other, how='intersection', keep_geom_type=True)` for polygon layers,
+    but vectorized: intersecting pairs are found with an STRtree and intersected with a single
+    call to `shapely.intersection`.
+    Parameters:
+        gdf (GeoDataFrame): Left GeoDataFrame.
+        other (GeoDataFrame): Right GeoDataFrame.
+        n_jobs (int, optional): Maximum number of threads used to compute the intersections.
+    Returns:
+        GeoDataFrame: One row per intersecting pair, with the attributes of both frames (columns
+            present in both get the suffixes '_1' and '_2', as in `overlay`) and the polygonal part
+            of their intersection. Pairs without a polygonal intersection are dropped.
+    """
+    geoms = gdf.geometry.to_numpy()
+    other_geoms = other.geometry.to_numpy()
+
+    tree = shapely.STRtree(other_geoms)
+    src, tgt = tree.query(geoms, predicate='intersects')
+
+    inter = _keep_polygons(map_chunks(shapely.intersection, [geoms[src], other_geoms[tgt]], n_jobs))
+    keep = ~shapely.is_empty(inter)
+    src, tgt, inter = src[keep], tgt[keep], inter[keep]
+
+    left_attrs = gdf.drop(columns=gdf.geometry.name).iloc[src].reset_index(drop=True)
+    right_attrs = other.drop(columns=other.geometry.name).iloc[tgt].reset_index(drop=True)
+    common = left_attrs.columns.intersection(right_attrs.columns)
+    left_attrs = left_attrs.rename(columns={c: f'{c}_1' for c in common})
+    right_attrs = right_attrs.rename(columns={c: f'{c}_2' for c in common})
+
+    result = pd.concat([left_attrs, right_attrs], axis=1)
+    result[gdf.geometry.name] = GeoSeries(inter, crs=gdf.crs)
+    return GeoDataFrame(result, geometry=gdf.geometry.name)
+
+
+def _dissolve_first(gdf:GeoDataFrame, by:str) -> GeoDataFrame:
+    """
+    Merge the geometries of the rows sharing the same `by` value, keeping the attributes of the first
+    row of each group. Equivalent to `gdf.dissolve(by=by, aggfunc='first').reset_index()` when the
+    attributes don't vary within a group, but the geometries are merged with one `shapely.union_all`
+    per group and the attributes are simply taken from the first row, skipping the pandas aggregation.
+    Parameters:
+        gdf (GeoDataFrame): GeoDataFrame to be dissolved.
+        by (str): Column with the group identifiers. Rows with missing identifiers are dropped.
+    Returns:
+        GeoDataFrame: One row per group, sorted by `by`, with the columns `by`, the geometry and
+            the remaining attributes, in this order.
+    """
+    geom_name = gdf.geometry.name
+    geoms = gdf.geometry.to_numpy()
+
+    codes, _ = pd.factorize(gdf[by], sort=True)
+    rows = np.flatnonzero(codes >= 0)
+    order = rows[np.argsort(codes[rows], kind='stable')]
+
+    _, starts = np.unique(codes[order], return_index=True)
+    groups = np.split(geoms[order], starts[1:]) if len(order) else []
+    first = order[starts]
+
+    result = gdf.drop(columns=[geom_name, by]).iloc[first].reset_index(drop=True)
+    result.insert(0, by, gdf[by].iloc[first].reset_index(drop=True))
+    result.insert(1, geom_name, GeoSeries([shapely.union_all(group) for group in groups], crs=gdf.crs))
+    return GeoDataFrame(result, geometry=geom_name)
 
 
 def prepare_tracts(df_tracts:GeoDataFrame,
-                   df_vegetation:GeoDataFrame = GeoDataFrame(),
-                   df_street_blocks:GeoDataFrame = GeoDataFrame(),
-                   tracts_id_col:str = None) -> GeoDataFrame:
+                   df_vegetation:GeoDataFrame = None,
+                   df_street_blocks:GeoDataFrame = None,
+                   tracts_id_col:str = None,
+                   n_jobs:int = None) -> GeoDataFrame:
     """
     Prepare census tracts by processing spatial overlays with optional vegetation and street block geometries.
     Parameters:
@@ -12,35 +176,33 @@ def prepare_tracts(df_tracts:GeoDataFrame,
         df_vegetation (GeoDataFrame, optional): A GeoDataFrame containing vegetation geometries. When provided, the function subtracts these areas from the census tracts.
         df_street_blocks (GeoDataFrame, optional): A GeoDataFrame containing street block geometries. When provided, the function refines the tracts by intersecting with street blocks and dissolves the resulting geometries based on the tract identifier.
         tracts_id_col (str, optional): The column name used as the tract identifier for dissolving geometries after intersecting with street blocks. If not provided, the first column of df_tracts is used.
+        n_jobs (int, optional): Maximum number of threads used in the overlays. If not provided, `os.cpu_count()` is used.
     Returns:
         GeoDataFrame: A new GeoDataFrame containing the adjusted tracts, including a new column 'adjusted_tract_area' that records the area of each geometry after processing.
     Notes:
         - The function performs a difference overlay with vegetation data (if available) followed by an intersection overlay with street blocks (if provided) and a subsequent dissolve operation.
+        - Invalid geometries are repaired with `shapely.make_valid` and empty geometries are dropped before the overlays.
         - The function assumes that the input GeoDataFrames use compatible coordinate reference systems for spatial operations.
     """
 
-    if not df_vegetation.empty:
-        ol1 = df_tracts.overlay(df_vegetation,
-                        how='difference',
-                        keep_geom_type=True)
-    else:
-        ol1 = df_tracts
+    ol1 = _sanitize(df_tracts)
 
-    if not df_street_blocks.empty:
+    if df_vegetation is not None and not df_vegetation.empty:
+        ol1 = _difference(ol1, _sanitize(df_vegetation), n_jobs)
+
+    if df_street_blocks is not None and not df_street_blocks.empty:
         if not tracts_id_col:
             tracts_id_col = df_tracts.columns[0]
 
-        ol2 = (
-            ol1.overlay(df_street_blocks[['geometry']],
-                        how='intersection',
-                        keep_geom_type=True)
-                .dissolve(by=tracts_id_col, aggfunc='first')
-                .reset_index()
+        ol2 = _dissolve_first(
+            _intersection(ol1, _sanitize(df_street_blocks.geometry.to_frame()), n_jobs),
+            tracts_id_col
         )
     else:
-        ol2 = ol1
+        # Sem camadas opcionais, ol1 pode ser o próprio df_tracts recebido
+        ol2 = ol1.copy(deep=False) if ol1 is df_tracts else ol1
 
-    ol2['adjusted_tract_area'] = ol2.area
+    ol2['adjusted_tract_area'] = shapely.area(ol2.geometry.to_numpy())
     
     return ol2
 
@@ -50,7 +212,8 @@ def prepare_risk_area(risk_area_gdf:GeoDataFrame,
                  active_risk_prefix:str,
                  subprefeitura_gdf:GeoDataFrame,
                  subprefeitura_id_col:str=None,
-                 subprefeitura_additional_cols:list[str]=None) -> GeoDataFrame:
+                 subprefeitura_additional_cols:list[str]=None,
+                 n_jobs:int=None) -> GeoDataFrame:
     """
     Prepares and overlays risk area data with subprefeitura data to generate a combined GeoDataFrame.
     This function filters the input risk area GeoDataFrame to retain only those areas whose risk grade
@@ -72,6 +235,7 @@ def prepare_risk_area(risk_area_gdf:GeoDataFrame,
                                                                 in the overlay operation. The geometry column is
                                                                 automatically included if not specified.
                                                                 Defaults to None.
+        n_jobs (int, optional): Maximum number of threads used in the overlay. Defaults to `os.cpu_count()`.
     Returns:
         GeoDataFrame: A GeoDataFrame resulting from the intersection of risk_area_gdf and subprefeitura_gdf,
                         which includes a new column 'id_area_subprefeitura' that uniquely identifies each area by
@@ -79,12 +243,15 @@ def prepare_risk_area(risk_area_gdf:GeoDataFrame,
     Notes:
         - The function assumes that the risk grade column is uniquely identified by the provided prefix,
             and it selects the first matching column.
-        - The overlay operation uses an "intersection" method with the parameter keep_geom_type set to True.
+        - The overlay is an "intersection" keeping only polygonal geometries (as keep_geom_type=True), computed
+            with the vectorized `_intersection` helper shared with `prepare_tracts`.
+        - Invalid geometries are repaired with `shapely.make_valid` and empty geometries are dropped before the overlay.
     """
 
 
-    col_grau = [c for c in risk_area_gdf.columns if risk_grade_col_prefix in c][0]
-    _gdf = risk_area_gdf.loc[risk_area_gdf[col_grau].str.lower().str.startswith(active_risk_prefix.lower())]
+    col_grau = next(c for c in risk_area_gdf.columns if risk_grade_col_prefix in c)
+    active = risk_area_gdf[col_grau].str.match(re.escape(active_risk_prefix), case=False, na=False)
+    _gdf = _sanitize(risk_area_gdf.loc[active])
 
     if not subprefeitura_id_col:
         subprefeitura_id_col = subprefeitura_gdf.columns[0]
@@ -95,23 +262,20 @@ def prepare_risk_area(risk_area_gdf:GeoDataFrame,
     if subprefeitura_gdf.geometry.name not in subprefeitura_additional_cols:
         subprefeitura_additional_cols.append(subprefeitura_gdf.geometry.name)
 
-    ol = _gdf.overlay(
-        subprefeitura_gdf[[subprefeitura_id_col] + subprefeitura_additional_cols],
-        how='intersection',
-        keep_geom_type=True
+    ol = _intersection(
+        _gdf,
+        _sanitize(subprefeitura_gdf[[subprefeitura_id_col] + subprefeitura_additional_cols]),
+        n_jobs
     )
 
     if not risk_area_id_col:
         risk_area_id_col=risk_area_gdf.columns[0]
 
 
-    ol.loc[:, 'id_area_subprefeitura'] = (
-        ol.loc[:, risk_area_id_col].astype(str) +
-        '.subpref.' +
-        ol.loc[:, subprefeitura_id_col].astype(str)
-    )
-
-    cols = ['id_area_subprefeitura'] + [col for col in ol.columns if col != 'id_area_subprefeitura']
-    ol = ol[cols]
+    ol.insert(0, 'id_area_subprefeitura', [
+        f'{risk_area_id}.subpref.{subprefeitura_id}'
+        for risk_area_id, subprefeitura_id in zip(ol[risk_area_id_col].to_numpy(),
+                                                  ol[subprefeitura_id_col].to_numpy())
+    ])
 
     return ol
\ No newline at end of file